@@ -7,14 +7,26 @@ https://github.com/esdc-esac-esa-int/Solar-MACH/blob/e3400de5a7ffced996c959384c3
 
 import math
 import base64
+import hashlib
 import io
+import os
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import astropy.constants as const
+import astropy.units as u
+from astropy.config import get_cache_dir
+from astropy.coordinates import concatenate
+from astropy.time import Time
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 from matplotlib.legend_handler import HandlerPatch
 from sunpy.coordinates import frames, get_horizons_coord
+from sunpy.time import parse_time
 
 from .models import Body
 
@@ -23,8 +35,109 @@ plt.rcParams["axes.linewidth"] = 1.5
 plt.rcParams["font.size"] = 15
 plt.rcParams["agg.path.chunksize"] = 20000
 
-pd.options.display.max_rows = None
-pd.options.display.float_format = "{:.1f}".format
+_AU_KM = const.au.to_value("km")
+_OMEGA_SID = math.radians(
+    360.0 / (25.38 * 24 * 60 * 60)
+)  # solar rot-angle in rad/sec, sidereal period
+
+# obstime is taken from the transformed coordinates, so one frame instance
+# can be shared by all transformations
+_CARRINGTON_FRAME = frames.HeliographicCarrington(observer="Sun")
+
+# max. number of simultaneous requests sent to JPL Horizons
+_HORIZONS_MAX_WORKERS = 8
+
+# only ephemerides of dates at least this old are cached on disk
+_HORIZONS_CACHE_MIN_AGE = 7 * u.day
+
+
+def _cached_horizons(body_id, date):
+    """
+    get_horizons_coord() with responses cached on disk, keyed by body id &
+    date. Any problem with the cache is treated as a cache miss, so it never
+    fails a query that Horizons itself could answer.
+
+    Parameters
+    ----------
+    body_id: int
+            JPL Horizons id of the body
+    date: str
+            e.g., '2020-03-22 12:30'
+    """
+    # ephemerides of recent & future dates are predictions which JPL may still
+    # revise (e.g. after spacecraft manoeuvres), so don't cache them
+    if parse_time(date) > Time.now() - _HORIZONS_CACHE_MIN_AGE:
+        return get_horizons_coord(body_id, date, "id")
+
+    try:
+        cache_dir = os.path.join(get_cache_dir(), "al1ssc_tools", "horizons")
+    except OSError:  # no usable cache location at all
+        return get_horizons_coord(body_id, date, "id")
+    key = hashlib.sha1(f"{body_id}|{date}".encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{key}.pkl")
+
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        # stale or unreadable entry (e.g. pickled by older astropy/sunpy)
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+    pos = get_horizons_coord(body_id, date, "id")
+
+    # write to a temporary file first, so a concurrent reader never sees a
+    # partially written pickle
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            tmp_path = f.name
+            pickle.dump(pos, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, pickle.PicklingError):
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    return pos
+
+
+def _backmap_kernel(lons, dists, vsws, reference_long):
+    """
+    Vectorized backmapping of several bodies (or of a body at several dates)
+
+    Parameters
+    ----------
+    lons: numpy.ndarray
+            Carrington longitudes of bodies in degrees
+    dists: numpy.ndarray
+            heliocentric distances of bodies in AU
+    vsws: numpy.ndarray
+            solar wind speeds (km/s) at the bodies
+    reference_long: float or None
+            Carrington longitude of reference point at Sun
+
+    out:
+        seps: numpy.ndarray
+            longitudinal separations of magnetic footpoints and reference longitude in degrees (NaN if reference_long is None)
+        alphas: numpy.ndarray
+            backmapping angles in degrees
+    """
+    alphas = np.degrees(_OMEGA_SID * dists * _AU_KM / vsws)
+
+    if reference_long is not None:
+        seps = (lons + alphas - reference_long + 180) % 360 - 180
+    else:
+        seps = np.full(np.shape(alphas), np.nan)
+
+    return seps, alphas
 
 
 class HeliosphericConstellation:
@@ -56,78 +169,33 @@ class HeliosphericConstellation:
         self.date = date
         self.reference_long = reference_long
         self.reference_lat = reference_lat
-
-        pos_E = get_horizons_coord(
-            399, self.date, "id"
-        )  # (lon, lat, radius) in (deg, deg, AU)
-        self.pos_E = pos_E.transform_to(
-            frames.HeliographicCarrington(observer="Sun")
-        )
+        self._fig = None
 
         if len(vsw_list) == 0:
             vsw_list = np.zeros(len(body_list)) + 400
 
-        bodies_dict = {}
-        body_lon_list = []
-        body_lat_list = []
-        body_dist_list = []
-        longsep_E_list = []
-        latsep_E_list = []
-        body_vsw_list = []
-        footp_long_list = []
-        longsep_list = []
-        latsep_list = []
-        footp_longsep_list = []
-
+        bodies = Body.objects.in_bulk(body_list, field_name="name")
+        body_ids = [399] + [
+            bodies[body_name].body_id for body_name in body_list
+        ]
+
+        # Horizons accepts a single target per request, so send them (once per
+        # distinct body) concurrently instead of waiting on each one in turn
+        unique_body_ids = list(dict.fromkeys(body_ids))
+        with ThreadPoolExecutor(
+            max_workers=min(len(unique_body_ids), _HORIZONS_MAX_WORKERS)
+        ) as executor:
+            futures = {
+                body_id: executor.submit(_cached_horizons, body_id, date)
+                for body_id in unique_body_ids
+            }  # (lon, lat, radius) in (deg, deg, AU)
+
+        pos_list = [futures[body_ids[0]].result()]  # Earth
+        found_bodies = []
         for i, body_name in enumerate(body_list):
-            body = Body.objects.get(name=body_name)
-            bodies_dict[body_name] = [body.body_id, body.name, body.color]
-
             try:
-                pos = get_horizons_coord(
-                    body.body_id, date, "id"
-                )  # (lon, lat, radius) in (deg, deg, AU)
-                pos = pos.transform_to(
-                    frames.HeliographicCarrington(observer="Sun")
-                )
-                bodies_dict[body_name].append(pos)
-                bodies_dict[body_name].append(vsw_list[i])
-
-                longsep_E = pos.lon.value - self.pos_E.lon.value
-                if longsep_E > 180:
-                    longsep_E = longsep_E - 360.0
-                latsep_E = pos.lat.value - self.pos_E.lat.value
-
-                body_lon_list.append(pos.lon.value)
-                body_lat_list.append(pos.lat.value)
-                body_dist_list.append(pos.radius.value)
-                longsep_E_list.append(longsep_E)
-                latsep_E_list.append(latsep_E)
-
-                body_vsw_list.append(vsw_list[i])
-
-                sep, alpha = self.backmapping(
-                    pos, date, reference_long, vsw=vsw_list[i]
-                )
-                bodies_dict[body_name].append(sep)
-
-                body_footp_long = pos.lon.value + alpha
-                if body_footp_long > 360:
-                    body_footp_long = body_footp_long - 360
-                footp_long_list.append(body_footp_long)
-
-                if self.reference_long is not None:
-                    bodies_dict[body_name].append(sep)
-                    long_sep = pos.lon.value - self.reference_long
-                    if long_sep > 180:
-                        long_sep = long_sep - 360.0
-
-                    longsep_list.append(long_sep)
-                    footp_longsep_list.append(sep)
-
-                if self.reference_lat is not None:
-                    lat_sep = pos.lat.value - self.reference_lat
-                    latsep_list.append(lat_sep)
+                pos_list.append(futures[body_ids[i + 1]].result())
+                found_bodies.append((i, body_name))
             except ValueError:
                 print("")
                 print(
@@ -136,34 +204,52 @@ class HeliosphericConstellation:
                     + '" for date '
                     + self.date
                 )
-                del bodies_dict[body_name]
 
-        self.body_dict = bodies_dict
-        self.max_dist = np.max(body_dist_list)
-        self.coord_table = pd.DataFrame(
-            {
-                "Body": list(self.body_dict.keys()),
-                "Longitude (°)": np.around(body_lon_list),
-                "Latitude (°)": np.around(body_lat_list),
-                "Heliocentric Distance (AU)": np.around(body_dist_list, 2),
-                "Longitudinal separation to Earth": np.around(longsep_E_list),
-                "Latitudinal separation to Earth": np.around(latsep_E_list),
-                # "Vsw": body_vsw_list,
-                # "Magnetic footpoint longitude (Carrington)": footp_long_list,
-            }
+        if not found_bodies:
+            raise RuntimeError(
+                "No ephemeris for any of the requested bodies for date "
+                + self.date
+            )
+
+        # transform all positions in one go, Earth being the first one
+        coords = concatenate(pos_list).transform_to(_CARRINGTON_FRAME)
+        self.pos_E = coords[0]
+
+        # per-body quantities are kept as index-aligned arrays (and lists)
+        self.labels = [bodies[body_name].name for _, body_name in found_bodies]
+        self.colors = [
+            bodies[body_name].color for _, body_name in found_bodies
+        ]
+        self.lons = coords.lon.value[1:]
+        self.lats = coords.lat.value[1:]
+        self.dists = coords.radius.value[1:]
+        self.vsws = np.array(
+            [vsw_list[i] for i, _ in found_bodies], dtype=float
         )
 
-        # if self.reference_long is not None:
-        #     self.coord_table[
-        #         "Longitudinal separation between body and reference_long"
-        #     ] = longsep_list
-        #     self.coord_table[
-        #         "Longitudinal separation between body's mangetic footpoint and reference_long"
-        #     ] = footp_longsep_list
-        # if self.reference_lat is not None:
-        #     self.coord_table[
-        #         "Latitudinal separation between body and reference_lat"
-        #     ] = latsep_list
+        longsep_E_arr = (self.lons - self.pos_E.lon.value + 180) % 360 - 180
+        latsep_E_arr = self.lats - self.pos_E.lat.value
+
+        self.max_dist = np.max(self.dists)
+        # one dict (row) per body
+        self.coord_table = [
+            {
+                "Body": body_name,
+                "Longitude (°)": lon,
+                "Latitude (°)": lat,
+                "Heliocentric Distance (AU)": dist,
+                "Longitudinal separation to Earth": longsep_E,
+                "Latitudinal separation to Earth": latsep_E,
+            }
+            for body_name, lon, lat, dist, longsep_E, latsep_E in zip(
+                self.labels,
+                np.around(self.lons).tolist(),
+                np.around(self.lats).tolist(),
+                np.around(self.dists, 2).tolist(),
+                np.around(longsep_E_arr).tolist(),
+                np.around(latsep_E_arr).tolist(),
+            )
+        ]
 
     def backmapping(self, body_pos, date, reference_long, vsw=400):
         """
@@ -172,43 +258,28 @@ class HeliosphericConstellation:
         Parameters
         ----------
         body_pos : astropy.coordinates.sky_coordinate.SkyCoord
-               coordinate of the body in Carrington coordinates
+               coordinate of the body in Carrington coordinates (can be array-valued, e.g. for several dates)
         date: str
               e.g., '2020-03-22 12:30'
         reference_long: float
                         Carrington longitude of reference point at Sun to which we determine the longitudinal separation
-        vsw: float
+        vsw: float or numpy.ndarray
              solar wind speed (km/s) used to determine the position of the magnetic footpoint of the body. Default is 400.
 
         out:
-            sep: float
+            sep: float or numpy.ndarray
                 longitudinal separation of body magnetic footpoint and reference longitude in degrees
-            alpha: float
+            alpha: float or numpy.ndarray
                 backmapping angle
         """
-        AU = const.au.value / 1000  # km
-
         pos = body_pos
         lon = pos.lon.value
         dist = pos.radius.value
 
-        omega = math.radians(
-            360.0 / (25.38 * 24 * 60 * 60)
-        )  # rot-angle in rad/sec, sidereal period
-
-        tt = dist * AU / vsw
-        alpha = math.degrees(omega * tt)
-
-        if reference_long is not None:
-            sep = (lon + alpha) - reference_long
-            if sep > 180.0:
-                sep = sep - 360
-
-            if sep < -180.0:
-                sep = 360 - abs(sep)
-        else:
-            sep = np.nan
+        sep, alpha = _backmap_kernel(lon, dist, vsw, reference_long)
 
+        if np.ndim(sep) == 0:
+            return float(sep), float(alpha)
         return sep, alpha
 
     def plot(
@@ -232,36 +303,30 @@ class HeliosphericConstellation:
         reference_vsw: int
                     if defined, defines solar wind speed for reference. if not defined, 400 km/s is used
         """
-        import pylab as pl
-
-        AU = const.au.value / 1000  # km
-
-        fig, ax = plt.subplots(
-            subplot_kw=dict(projection="polar"), figsize=(12, 8)
+        fig, ax = self._get_fig()
+
+        # spiral angle changes by ~61 deg/AU (at 400 km/s), so sample r
+        # geometrically close to the Sun, then linearly in 0.02 AU steps
+        # (~1 deg of spiral per segment) beyond 1 AU
+        r_max = self.max_dist + 0.3
+        r_break = min(1.0, r_max)
+        n_outer = int(np.ceil((r_max - r_break) / 0.02)) + 1
+        r = np.concatenate(
+            (
+                np.geomspace(0.01, r_break, 200),
+                np.linspace(r_break, r_max, n_outer)[1:],
+            )
         )
-        self.ax = ax
-
-        r = np.arange(0.007, self.max_dist + 0.3, 0.001)
-        omega = np.radians(
-            360.0 / (25.38 * 24 * 60 * 60)
-        )  # solar rot-angle in rad/sec, sidereal period
-
-        for body_name in self.body_dict:
-            body_lab = self.body_dict[body_name][1]
-            body_color = self.body_dict[body_name][2]
-            body_pos = self.body_dict[body_name][3]
-            body_vsw = self.body_dict[body_name][4]
 
-            pos = body_pos
-            dist_body = pos.radius.value
-            body_long = pos.lon.value
-
-            E_long = self.pos_E.lon.value
-            dist_e = self.pos_E.radius.value
+        E_long = self.pos_E.lon.value
+        dist_e = self.pos_E.radius.value
 
+        for body_lab, body_color, body_long, dist_body in zip(
+            self.labels, self.colors, self.lons, self.dists
+        ):
             # plot body positions
             ax.plot(
-                np.deg2rad(body_long),
+                math.radians(body_long),
                 dist_body,
                 "s",
                 color=body_color,
@@ -270,31 +335,40 @@ class HeliosphericConstellation:
             if plot_sun_body_line:
                 # ax.plot(alpha_ref[0], 0.01, 0)
                 ax.plot(
-                    [np.deg2rad(body_long), np.deg2rad(body_long)],
+                    [math.radians(body_long), math.radians(body_long)],
                     [0.01, dist_body],
                     ":",
                     color=body_color,
                 )
-            # plot the spirals
-            if plot_spirals:
-                tt = dist_body * AU / body_vsw
-                alpha = np.degrees(omega * tt)
-                alpha_body = np.deg2rad(body_long) + omega / (body_vsw / AU) * (
-                    dist_body - r
-                )
-                ax.plot(alpha_body, r, color=body_color)
+
+        # plot the spirals of all bodies at once, as one collection of lines
+        if plot_spirals:
+            segments = np.empty((len(self.lons), len(r), 2))  # (theta, r)
+            segments[..., 1] = r
+            # compute spiral angles in place, straight into the segments
+            alpha_all = segments[..., 0]
+            np.subtract(self.dists[:, None], r[None, :], out=alpha_all)
+            np.multiply(
+                alpha_all,
+                (_OMEGA_SID * _AU_KM / self.vsws)[:, None],
+                out=alpha_all,
+            )
+            np.add(alpha_all, np.deg2rad(self.lons)[:, None], out=alpha_all)
+            ax.add_collection(
+                LineCollection(segments, colors=self.colors, linewidths=1.5)
+            )
 
         if self.reference_long is not None:
             delta_ref = self.reference_long
             if delta_ref < 0.0:
                 delta_ref = delta_ref + 360.0
             alpha_ref = (
-                np.deg2rad(delta_ref)
-                + omega / (reference_vsw / AU) * (dist_e / AU - r)
-                - (omega / (reference_vsw / AU) * (dist_e / AU))
+                math.radians(delta_ref)
+                + _OMEGA_SID / (reference_vsw / _AU_KM) * (dist_e / _AU_KM - r)
+                - (_OMEGA_SID / (reference_vsw / _AU_KM) * (dist_e / _AU_KM))
             )
             arrow_dist = min([round(self.max_dist / 3.2, 6), 2.0])
-            ref_arr = plt.arrow(
+            ref_arr = ax.arrow(
                 alpha_ref[0],
                 0.01,
                 0,
@@ -342,20 +416,11 @@ class HeliosphericConstellation:
             ax.add_artist(leg1)
 
         ax.set_rlabel_position(E_long + 120)
-        ax.set_theta_offset(np.deg2rad(270 - E_long))
+        ax.set_theta_offset(math.radians(270 - E_long))
         ax.set_rmax(self.max_dist + 0.3)
         ax.set_rmin(0.01)
         ax.yaxis.get_major_locator().base.set_params(nbins=4)
-        circle = plt.Circle(
-            (0.0, 0.0),
-            self.max_dist + 0.29,
-            transform=ax.transData._b,
-            edgecolor="k",
-            facecolor=None,
-            fill=False,
-            lw=2,
-        )
-        ax.add_patch(circle)
+        ax.spines["polar"].set_linewidth(2)
 
         # manually plot r-grid lines with different resolution depending on maximum distance bodyz
         if self.max_dist < 2:
@@ -371,28 +436,37 @@ class HeliosphericConstellation:
             f"At {self.date.replace('T', ' ')} UTC\n", fontsize=15, pad=56
         )
 
-        plt.tight_layout()
-        plt.subplots_adjust(bottom=0.15)
-
         if show_earth_centered_coord:
-            pos1 = (
-                ax.get_position()
-            )  # get the original position of the polar plot
-            offset = 0.12
-            pos2 = [
-                pos1.x0 - offset / 2,
-                pos1.y0 - offset / 2,
-                pos1.width + offset,
-                pos1.height + offset,
-            ]
-            ax2 = self._polar_twin(ax, E_long, pos2)
+            # additional longitudinal tickmarks with Earth at longitude 0
+            earth_ticks = np.arange(0, 360, 45)
+            # keep all of them even when they coincide with the major ticks
+            ax.xaxis.remove_overlapping_locs = False
+            ax.set_xticks(np.deg2rad((earth_ticks + E_long) % 360), minor=True)
+            ax.set_xticklabels(
+                [f"{tick}°" for tick in earth_ticks], minor=True
+            )
+            ax.tick_params(axis="x", which="minor", colors="darkgreen", pad=35)
+            ax.xaxis.grid(True, which="minor", color="darkgreen")
 
         ax.tick_params(axis="x", pad=10)
 
+        # fixed margins, tuned to leave just enough room for the tick labels,
+        # title & legends (what bbox_inches="tight" used to crop to)
+        fig.subplots_adjust(left=0.093, right=0.597, bottom=0.095, top=0.75)
+
         # Save figure in in memory as png and convert it to base64 encoded string
         img_IObytes = io.BytesIO()
-        plt.savefig(img_IObytes, format="png", bbox_inches="tight")
-        # plt.savefig("plot.png", bbox_inches="tight")  # for debugging
+        # layout is already fixed by subplots_adjust() above, so
+        # bbox_inches="tight" (which renders the figure twice) isn't needed.
+        # Low zlib compression is much faster to encode at the cost of a
+        # slightly bigger image
+        fig.savefig(
+            img_IObytes,
+            format="png",
+            dpi=100,
+            pil_kwargs={"compress_level": 1},
+        )
+        # fig.savefig("plot.png", dpi=100)  # for debugging
         img_base64 = base64.b64encode(img_IObytes.getvalue()).decode("utf-8")
         return img_base64
 
@@ -402,25 +476,19 @@ class HeliosphericConstellation:
         # img_svg = img_IOstring.getvalue() # do contain whitespaces - can be removed by xml parser but not much savings on size
         # return img_svg
 
-    def _polar_twin(self, ax, E_long, position):
+    def _get_fig(self):
         """
-        add an additional axes which is needed to plot additional longitudinal tickmarks with Earth at longitude 0
+        create the figure with polar axes on 1st call, and reuse it (cleared) on subsequent calls
         """
-        ax2 = ax.figure.add_axes(
-            position,
-            projection="polar",
-            label="twin",
-            frameon=False,
-            theta_direction=ax.get_theta_direction(),
-            theta_offset=E_long,
-        )
-
-        ax2.set_rmax(self.max_dist + 0.3)
-        ax2.yaxis.set_visible(False)
-        ax2.set_theta_zero_location("S")
-        ax2.tick_params(axis="x", colors="darkgreen", pad=10)
-        gridlines = ax2.xaxis.get_gridlines()
-        for xax in gridlines:
-            xax.set_color("darkgreen")
+        if self._fig is None:
+            # not created through pyplot, so that the figure isn't kept alive
+            # by pyplot's figure manager beyond the lifetime of this instance.
+            # Attaching an Agg canvas once lets savefig() reuse its renderer
+            # instead of creating a new one on every call
+            self._fig = Figure(figsize=(10.4, 8))
+            FigureCanvasAgg(self._fig)
+            self.ax = self._fig.add_subplot(projection="polar")
+        else:
+            self.ax.cla()
 
-        return ax2
+        return self._fig, self.ax
@@ -1,3 +1,69 @@
-from django.test import TestCase
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from . import orbit_plotter_2D
+from .orbit_plotter_2D import _cached_horizons
+
+
+class CachedHorizonsTests(SimpleTestCase):
+    """Tests for the on-disk cache of JPL Horizons coordinates"""
+
+    date = "2020-03-22 12:30"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_root = tmp_dir.name
+
+        patcher = mock.patch.object(
+            orbit_plotter_2D, "get_cache_dir", return_value=self.cache_root
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(
+            orbit_plotter_2D,
+            "get_horizons_coord",
+            side_effect=lambda body_id, date, id_type: (body_id, date),
+        )
+        self.horizons = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cache_files(self):
+        cache_dir = os.path.join(self.cache_root, "al1ssc_tools", "horizons")
+        return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)]
+
+    def test_miss_queries_horizons_and_caches(self):
+        self.assertEqual(_cached_horizons(399, self.date), (399, self.date))
+        self.assertEqual(self.horizons.call_count, 1)
+        self.assertEqual(len(self.cache_files()), 1)
+
+    def test_hit_does_not_query_horizons(self):
+        _cached_horizons(399, self.date)
+        self.assertEqual(_cached_horizons(399, self.date), (399, self.date))
+        self.assertEqual(self.horizons.call_count, 1)
+
+    def test_corrupt_entry_is_refetched_and_replaced(self):
+        _cached_horizons(399, self.date)
+        (cache_path,) = self.cache_files()
+        with open(cache_path, "wb") as f:
+            f.write(b"\x80\x09not a pickle")  # unsupported protocol
+
+        self.assertEqual(_cached_horizons(399, self.date), (399, self.date))
+        self.assertEqual(self.horizons.call_count, 2)
+        # the rewritten entry is served from disk again
+        self.assertEqual(_cached_horizons(399, self.date), (399, self.date))
+        self.assertEqual(self.horizons.call_count, 2)
+
+    def test_recent_dates_are_not_cached(self):
+        _cached_horizons(399, "2100-01-01 00:00")
+        _cached_horizons(399, "2100-01-01 00:00")
+        self.assertEqual(self.horizons.call_count, 2)
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.cache_root, "al1ssc_tools", "horizons")
+            )
+        )
@@ -39,7 +39,7 @@ def get_2Dorbit_plot(request):
             show_earth_centered_coord,
             reference_vsw,
         )
-        tabular_data = hc.coord_table.to_dict("records")  # list of dictionaries
+        tabular_data = hc.coord_table  # list of dictionaries
 
         return JsonResponse(
             dict(